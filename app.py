@@ -1,34 +1,82 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Request, request, jsonify
 from flask_cors import CORS
+from flask_compress import Compress
+from flask.json.provider import JSONProvider
+import orjson
 from dotenv import load_dotenv
 import os
-from pymongo import MongoClient
+from werkzeug.exceptions import RequestEntityTooLarge
+from pymongo.write_concern import WriteConcern
+from pymongo.errors import DuplicateKeyError
 from bson import ObjectId
+from db import get_client, get_db
 from model_pipeline import full_image_analysis, validate_image_for_analysis
-import base64
-import traceback
-import time
+import pybase64
 from io import BytesIO
 from PIL import Image
 import hashlib
+import hmac
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+import fastjsonschema
 from datetime import datetime
-import google.generativeai as genai
+import gevent
+from gevent import monkey
+from argon2 import PasswordHasher
+from argon2.exceptions import VerifyMismatchError, InvalidHashError
+from cachetools import TTLCache
 
 # Load environment variables
 load_dotenv()
 
+# Logging: request threads only enqueue records, a background listener does the writes
+log_queue = queue.SimpleQueue()
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(), handlers=[QueueHandler(log_queue)])
+log_listener = QueueListener(log_queue, logging.StreamHandler())
+log_listener.start()
+log = logging.getLogger("app")
+
+class InMemoryUploadRequest(Request):
+    """Keep uploaded files in memory; Werkzeug would spool anything over 500KB to a temp file"""
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return BytesIO()
+
+class ORJSONProvider(JSONProvider):
+    """jsonify() backed by orjson; anything orjson can't encode natively falls back to str()"""
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=str).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, default=str), mimetype="application/json")
+
 app = Flask(__name__)
+app.request_class = InMemoryUploadRequest
+# Hard cap on any request body, enforced while reading (also for chunked uploads without
+# Content-Length), so the in-memory upload buffer can't grow without bound. Leaves room
+# for /save-meal JSON carrying a base64 (4/3 size) copy of a 10MB image plus its thumbnail.
+# Routes re-raise RequestEntityTooLarge so it reaches the 413 handler instead of their 500.
+app.config["MAX_CONTENT_LENGTH"] = 16 * 1024 * 1024
+app.json = ORJSONProvider(app)
 CORS(app, supports_credentials=True)
 
-# Configure MongoDB with connection pooling
-client = MongoClient(
-    os.getenv("MONGO_URI"),
-    maxPoolSize=50,
-    minPoolSize=10,
-    maxIdleTimeMS=30000,
-    serverSelectionTimeoutMS=5000
-)
-db = client[os.getenv("MONGO_DB", "food-app-swift")]
+# Compress large JSON responses (meal lists carry base64 thumbnails)
+app.config["COMPRESS_MIMETYPES"] = ["application/json"]
+app.config["COMPRESS_LEVEL"] = 5
+app.config["COMPRESS_BR_LEVEL"] = 5
+app.config["COMPRESS_MIN_SIZE"] = 1024
+app.config["COMPRESS_ALGORITHM"] = ["br", "gzip"]
+Compress(app)
+
+# Shared MongoDB client (see db.py)
+client = get_client()
+db = get_db()
 
 # Create indexes for better performance
 users_collection = db["users"]
@@ -38,16 +86,137 @@ profiles_collection = db["profiles"]
 profiles_collection.create_index("user_id")
 
 meals_collection = db["meals"]
-meals_collection.create_index([("user_id", 1), ("saved_at", -1)])
+meals_collection.create_index([("user_id", 1), ("saved_at", -1), ("_id", -1)])
+
+exercise_collection = db["exercise"]
+exercise_collection.create_index([("user_id", 1), ("recorded_at", -1)])
+
+water_collection = db["water"]
+water_collection.create_index([("user_id", 1), ("recorded_at", -1)])
+
+weight_collection = db["weight"]
+weight_collection.create_index([("user_id", 1), ("recorded_at", -1)])
+
+# Required request fields for the tracking endpoints
+REQUIRED_EXERCISE_FIELDS = frozenset(("user_id", "exercise_type", "duration"))
+REQUIRED_WATER_FIELDS = frozenset(("user_id", "amount"))
+REQUIRED_WEIGHT_FIELDS = frozenset(("user_id", "weight"))
+
+# Meal saves are acknowledged by the primary but not journaled, so a 200 means the meal was stored
+meals_fast_write_collection = meals_collection.with_options(write_concern=WriteConcern(w=1, j=False))
+
+
+# Reject decompression bombs well below Pillow's default limit; uploads are capped at 10MB
+Image.MAX_IMAGE_PIXELS = 50_000_000
+
+# Request body validators, compiled once at import
+NON_EMPTY_STRING = {"type": "string", "minLength": 1}
+
+validate_register = fastjsonschema.compile({
+    "type": "object",
+    "required": ["name", "email", "password"],
+    "properties": {
+        "name": NON_EMPTY_STRING,
+        "email": NON_EMPTY_STRING,
+        "password": NON_EMPTY_STRING
+    }
+})
+
+validate_profile = fastjsonschema.compile({
+    "type": "object",
+    "required": ["user_id"],
+    "properties": {
+        "user_id": NON_EMPTY_STRING
+    }
+})
+
+validate_meal = fastjsonschema.compile({
+    "type": "object",
+    "required": ["user_id", "dish_prediction", "image_description", "nutrition_info"],
+    "properties": {
+        "user_id": {"type": "string"},
+        "dish_prediction": {"type": "string"},
+        "image_description": {"type": "string"},
+        "nutrition_info": {"type": "string"}
+    }
+})
+
+# Password hashing (argon2) and a short-lived cache of login lookups
+password_hasher = PasswordHasher()
+login_cache = TTLCache(maxsize=10000, ttl=60)
+login_cache_lock = threading.Lock()
+# Verified against for unknown emails, so they take as long as a wrong password
+DUMMY_PASSWORD_HASH = password_hasher.hash("not-a-real-password")
+
+# Profiles change rarely but are read often; invalidated on save-profile
+profile_cache = TTLCache(maxsize=10000, ttl=120)
+profile_cache_lock = threading.Lock()
+
+def run_off_event_loop(fn, *args):
+    """Run CPU-heavy work on gevent's native threadpool so it doesn't stall the event loop"""
+    # Under the gevent worker every request shares one OS thread; argon2 releases the GIL
+    if monkey.is_module_patched("threading"):
+        return gevent.get_hub().threadpool.apply(fn, args)
+    return fn(*args)
+
+def hash_password(password):
+    """Hash a password with argon2"""
+    return run_off_event_loop(password_hasher.hash, password)
 
-# Configure Gemini for nutrition recalculation
-genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
-gemini_model = genai.GenerativeModel('gemini-1.5-flash')
+def verify_password(stored_hash, password):
+    """Check a password against an argon2 hash, accepting legacy SHA256 hashes"""
+    if not stored_hash.startswith("$argon2"):
+        # Legacy hashes are SHA256 hex digests; anything else can't match
+        if len(stored_hash) != 64:
+            return False
+        legacy_hash = hashlib.sha256(password.encode()).hexdigest()
+        return hmac.compare_digest(stored_hash, legacy_hash)
+    try:
+        return run_off_event_loop(password_hasher.verify, stored_hash, password)
+    except (VerifyMismatchError, InvalidHashError):
+        return False
+
+def lookup_profile(user_id):
+    """Return a user's profile (with string _id), served from profile_cache when fresh"""
+    with profile_cache_lock:
+        cached = profile_cache.get(user_id)
+    if cached:
+        return cached
+
+    profile = profiles_collection.find_one({"user_id": user_id})
+    if not profile:
+        return None
+
+    profile["_id"] = str(profile["_id"])
+    with profile_cache_lock:
+        profile_cache[user_id] = profile
+    return profile
+
+def password_needs_rehash(stored_hash):
+    """Legacy SHA256 hashes and argon2 hashes with outdated parameters get upgraded on login"""
+    if not stored_hash.startswith("$argon2"):
+        return True
+    return password_hasher.check_needs_rehash(stored_hash)
+
+def lookup_login_user(email):
+    """Return (password_hash, user_id, name) for an email, cached for a short time"""
+    with login_cache_lock:
+        cached = login_cache.get(email)
+    if cached:
+        return cached
+
+    user = users_collection.find_one({"email": email}, {"_id": 1, "name": 1, "password": 1})
+    if not user:
+        return None
+
+    entry = (user["password"], str(user["_id"]), user["name"])
+    with login_cache_lock:
+        login_cache[email] = entry
+    return entry
 
 
 # Debug Process
-print("✅ Connected to MongoDB URI:", os.getenv("MONGO_URI"))
-print("✅ Using DB name:", db.name)
+log.info("✅ Using DB name: %s", db.name)
 
 @app.route("/ping", methods=["GET"])
 def ping():
@@ -83,24 +252,19 @@ def health():
 
 @app.route("/register", methods=["POST"])
 def register():
-    print("📩 /register endpoint called")
     try:
         data = request.get_json()
         if not data:
             return jsonify({"error": "Empty request"}), 400
         
         # Validate required fields
-        required_fields = ["name", "email", "password"]
-        missing_fields = [field for field in required_fields if field not in data or not data[field]]
-        if missing_fields:
-            return jsonify({"error": f"Missing fields: {', '.join(missing_fields)}"}), 400
+        try:
+            validate_register(data)
+        except fastjsonschema.JsonSchemaException as e:
+            return jsonify({"error": f"Invalid request: {e.message}"}), 400
             
-        # Check if email already exists
-        if users_collection.find_one({"email": data["email"]}):
-            return jsonify({"error": "Email already registered"}), 409
-
-        # Hash password with SHA256
-        hashed_pw = hashlib.sha256(data["password"].encode()).hexdigest()
+        # Hash password with argon2
+        hashed_pw = hash_password(data["password"])
         
         user = {
             "name": data["name"],
@@ -109,15 +273,23 @@ def register():
             "created_at": datetime.now().isoformat()
         }
         
-        result = users_collection.insert_one(user)
-        print(f"✅ Inserted user with ID: {result.inserted_id}")
+        # The unique email index rejects duplicates, no need for a separate lookup
+        try:
+            result = users_collection.insert_one(user)
+        except DuplicateKeyError:
+            return jsonify({"error": "Email already registered"}), 409
+        with login_cache_lock:
+            login_cache.pop(data["email"], None)
+        log.debug("✅ Inserted user with ID: %s", result.inserted_id)
         return jsonify({
             "user_id": str(result.inserted_id), 
             "name": data["name"]
         }), 200
         
+    except RequestEntityTooLarge:
+        raise
     except Exception as e:
-        print(f"❌ Register error: {str(e)}")
+        log.error("❌ Register error: %s", e)
         return jsonify({"error": "Registration failed"}), 500
 
 @app.route("/login", methods=["POST"])
@@ -131,22 +303,35 @@ def login():
         if not data.get("email") or not data.get("password"):
             return jsonify({"error": "Email and password required"}), 400
             
-        user = users_collection.find_one({"email": data["email"]})
+        user = lookup_login_user(data["email"])
         if not user:
+            # Same argon2 cost as a known email, so response time doesn't reveal registered emails
+            verify_password(DUMMY_PASSWORD_HASH, data["password"])
             return jsonify({"error": "Invalid email or password"}), 401
 
         # Check password
-        input_pw_hash = hashlib.sha256(data["password"].encode()).hexdigest()
-        if user["password"] != input_pw_hash:
+        password_hash, user_id, name = user
+        if not verify_password(password_hash, data["password"]):
             return jsonify({"error": "Invalid email or password"}), 401
 
+        # Migrate legacy hashes now that we know the plaintext is correct
+        if password_needs_rehash(password_hash):
+            users_collection.update_one(
+                {"_id": ObjectId(user_id)},
+                {"$set": {"password": hash_password(data["password"])}}
+            )
+            with login_cache_lock:
+                login_cache.pop(data["email"], None)
+
         return jsonify({
-            "user_id": str(user["_id"]), 
-            "name": user["name"]
+            "user_id": user_id, 
+            "name": name
         }), 200
         
+    except RequestEntityTooLarge:
+        raise
     except Exception as e:
-        print(f"❌ Login error: {str(e)}")
+        log.error("❌ Login error: %s", e)
         return jsonify({"error": "Login failed"}), 500
 
 @app.route("/save-profile", methods=["POST"])
@@ -156,23 +341,31 @@ def save_profile():
         if not data:
             return jsonify({"error": "Empty or invalid JSON"}), 400
 
-        user_id = data.get("user_id")
-        if not user_id:
-            return jsonify({"error": "Missing user_id"}), 400
+        try:
+            validate_profile(data)
+        except fastjsonschema.JsonSchemaException as e:
+            return jsonify({"error": f"Invalid request: {e.message}"}), 400
+        user_id = data["user_id"]
 
         # Remove user_id from data before saving
-        profile_data = {k: v for k, v in data.items() if k != "user_id"}
+        profile_data = dict(data)
+        profile_data.pop("user_id")
         profile_data["updated_at"] = datetime.now().isoformat()
         
-        profiles_collection.update_one(
+        result = profiles_collection.update_one(
             {"user_id": user_id},
             {"$set": profile_data},
             upsert=True
         )
+        with profile_cache_lock:
+            profile_cache.pop(user_id, None)
         
-        return jsonify({"message": "Profile saved"}), 200
+        # Tell the client whether this created the profile so it can skip a follow-up GET
+        return jsonify({"message": "Profile saved", "created": result.upserted_id is not None}), 200
+    except RequestEntityTooLarge:
+        raise
     except Exception as e:
-        print(f"❌ Save profile error: {str(e)}")
+        log.error("❌ Save profile error: %s", e)
         return jsonify({"error": str(e)}), 500
 
 @app.route("/get-profile", methods=["GET"])
@@ -182,129 +375,108 @@ def get_profile():
         if not user_id:
             return jsonify({"error": "Missing user_id parameter"}), 400
 
-        profile = profiles_collection.find_one({"user_id": user_id})
+        profile = lookup_profile(user_id)
         if not profile:
             return jsonify({"error": "Profile not found"}), 404
 
-        profile["_id"] = str(profile["_id"])
         return jsonify(profile), 200
     except Exception as e:
-        print(f"❌ Get profile error: {str(e)}")
+        log.error("❌ Get profile error: %s", e)
         return jsonify({"error": str(e)}), 500
 
+# Shared pool for image analyses; a timed-out request returns without waiting on its worker.
+# Its size caps how many analyses (and their Gemini calls) are in flight at once.
+ANALYSIS_MAX_CONCURRENCY = int(os.getenv("ANALYSIS_MAX_CONCURRENCY", "8"))
+analysis_executor = ThreadPoolExecutor(max_workers=ANALYSIS_MAX_CONCURRENCY)
+
+MAX_IMAGE_SIZE = 10 * 1024 * 1024  # 10MB limit
+MAX_ANALYZE_REQUEST_SIZE = MAX_IMAGE_SIZE + 64 * 1024  # room for multipart headers and user_id
+
 @app.route("/analyze", methods=["POST"])
 def analyze():
     """Image analysis endpoint - based on working web app"""
     try:
+        # Reject oversized uploads from the header, before the multipart body is parsed
+        if request.content_length and request.content_length > MAX_ANALYZE_REQUEST_SIZE:
+            return jsonify({"error": "Image too large. Please use an image under 10MB"}), 413
+
         if "image" not in request.files:
             return jsonify({"error": "No image part in the request"}), 400
 
         image_file = request.files["image"]
         user_id = request.form.get("user_id", "guest")
 
+        # Keep the upload in memory; the pipeline works on bytes, no temp file needed
+        image_bytes = image_file.read()
+        file_size = len(image_bytes)
+
         # Validate file size (limit to 10MB)
-        image_file.seek(0, 2)  # Seek to end
-        file_size = image_file.tell()
-        image_file.seek(0)  # Reset to beginning
-        
-        if file_size > 10 * 1024 * 1024:  # 10MB limit
+        if file_size > MAX_IMAGE_SIZE:
             return jsonify({"error": "Image too large. Please use an image under 10MB"}), 413
 
         if file_size < 1024:  # Too small
             return jsonify({"error": "Image too small. Please use a clearer image"}), 400
 
-        filename = f"image_{int(time.time())}.png"
-        image_path = os.path.join("/tmp", filename)
-        image_file.save(image_path)
+        log.debug("📸 Received image %s (size: %.2fMB)", image_file.filename, file_size / 1024 / 1024)
 
-        print(f"📸 Saved image to: {image_path} (size: {file_size / 1024 / 1024:.2f}MB)")
-
-        # Validate image before analysis
-        is_valid, validation_msg = validate_image_for_analysis(image_path)
-        if not is_valid:
-            try:
-                os.remove(image_path)
-            except:
-                pass
+        # Validate image before analysis; the opened image is reused by the pipeline
+        image, validation_msg = validate_image_for_analysis(image_bytes)
+        if image is None:
             return jsonify({"error": f"Invalid image: {validation_msg}"}), 400
 
         # Perform analysis with timeout handling
-        from concurrent.futures import ThreadPoolExecutor, TimeoutError
-        import concurrent.futures
-        
-        with ThreadPoolExecutor(max_workers=1) as executor:
-            future = executor.submit(full_image_analysis, image_path, user_id)
-            try:
-                # Give it 90 seconds to complete
-                result = future.result(timeout=90)
-                
-                # Check if analysis actually succeeded
-                if "error" in result:
-                    print(f"⚠️ Analysis contained errors: {result.get('error', 'Unknown error')}")
-                    # Clean up and return error
-                    try:
-                        os.remove(image_path)
-                    except:
-                        pass
-                    return jsonify({
-                        "error": f"Analysis failed: {result.get('error', 'Unknown error')}",
-                        "suggestion": "Please try with a clearer image of food"
-                    }), 500
-                
-                # Validate that we got meaningful results
-                if (result.get("dish_prediction", "").lower().startswith("analysis failed") or
-                    result.get("dish_prediction", "").lower().startswith("could not identify") or
-                    result.get("dish_prediction", "").lower().startswith("unable to analyze")):
-                    try:
-                        os.remove(image_path)
-                    except:
-                        pass
-                    return jsonify({
-                        "error": "Unable to analyze this image",
-                        "suggestion": "Please ensure the image clearly shows food items"
-                    }), 422
-                
-            except concurrent.futures.TimeoutError:
-                print("⏱️ Analysis timeout")
-                try:
-                    os.remove(image_path)
-                except:
-                    pass
+        future = analysis_executor.submit(full_image_analysis, image_bytes, user_id, image)
+        try:
+            # Give it 90 seconds to complete
+            result = future.result(timeout=90)
+            
+            # Check if analysis actually succeeded
+            if "error" in result:
+                log.warning("⚠️ Analysis contained errors: %s", result.get('error', 'Unknown error'))
                 return jsonify({
-                    "error": "Analysis timeout",
-                    "suggestion": "Please try with a simpler or clearer image"
-                }), 408
+                    "error": f"Analysis failed: {result.get('error', 'Unknown error')}",
+                    "suggestion": "Please try with a clearer image of food"
+                }), 500
+            
+            # Validate that we got meaningful results
+            if (result.get("dish_prediction", "").lower().startswith("analysis failed") or
+                result.get("dish_prediction", "").lower().startswith("could not identify") or
+                result.get("dish_prediction", "").lower().startswith("unable to analyze")):
+                return jsonify({
+                    "error": "Unable to analyze this image",
+                    "suggestion": "Please ensure the image clearly shows food items"
+                }), 422
+            
+        except FuturesTimeoutError:
+            # Drop the job if it is still queued behind other analyses; the client has given up
+            future.cancel()
+            log.warning("⏱️ Analysis timeout")
+            return jsonify({
+                "error": "Analysis timeout",
+                "suggestion": "Please try with a simpler or clearer image"
+            }), 408
         
         result["user_id"] = user_id
-        print(f"✅ Analysis completed for {filename}")
-        print(f"📊 Dish: {result.get('dish_prediction', 'Unknown')}")
-        print(f"📊 Hidden ingredients: {result.get('hidden_ingredients', 'None')[:100]}...")
-        print(f"⏱️ Analysis time: {result.get('analysis_time', 0):.2f}s")
-        
-        # Debug: Check if hidden ingredients exist
-        if result.get('hidden_ingredients'):
-            print(f"🔍 Hidden ingredients length: {len(result['hidden_ingredients'])}")
-            print(f"🔍 Hidden ingredients preview: {result['hidden_ingredients'][:200]}...")
-        else:
-            print("⚠️ No hidden ingredients in result")
-        
-        # Clean up
-        try:
-            os.remove(image_path)
-        except:
-            pass
+        # Skip building the debug summary entirely unless DEBUG logging is on
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("✅ Analysis completed for %s", image_file.filename)
+            log.debug("📊 Dish: %s", result.get('dish_prediction', 'Unknown'))
+            log.debug("📊 Hidden ingredients: %.100s...", result.get('hidden_ingredients', 'None'))
+            log.debug("⏱️ Analysis time: %.2fs", result.get('analysis_time', 0))
+            
+            # Debug: Check if hidden ingredients exist
+            if result.get('hidden_ingredients'):
+                log.debug("🔍 Hidden ingredients length: %d", len(result['hidden_ingredients']))
+                log.debug("🔍 Hidden ingredients preview: %.200s...", result['hidden_ingredients'])
+            else:
+                log.debug("⚠️ No hidden ingredients in result")
             
         return jsonify(result), 200
 
+    except RequestEntityTooLarge:
+        raise
     except Exception as e:
-        print("❌ analyze Exception:", str(e))
-        traceback.print_exc()
-        # Clean up on error
-        try:
-            if 'image_path' in locals():
-                os.remove(image_path)
-        except:
-            pass
+        log.exception("❌ analyze Exception: %s", e)
         return jsonify({
             "error": "Analysis failed",
             "details": str(e)
@@ -316,12 +488,13 @@ def analyze_enhanced():
     try:
         # Since our main analysis is already fully dynamic and enhanced, 
         # we can redirect to it with additional context
-        print("🔄 Enhanced analysis requested - using fully dynamic analysis")
+        log.debug("🔄 Enhanced analysis requested - using fully dynamic analysis")
         return analyze()
         
+    except RequestEntityTooLarge:
+        raise
     except Exception as e:
-        print("❌ Enhanced analyze Exception:", str(e))
-        traceback.print_exc()
+        log.exception("❌ Enhanced analyze Exception: %s", e)
         return jsonify({
             "error": "Enhanced analysis failed",
             "details": str(e)
@@ -329,14 +502,14 @@ def analyze_enhanced():
 
 def compress_base64_image(base64_str, quality=5):
     try:
-        image_data = base64.b64decode(base64_str)
+        image_data = pybase64.b64decode(base64_str)
         image = Image.open(BytesIO(image_data)).convert("RGB")
         buffer = BytesIO()
         image.save(buffer, format="JPEG", quality=quality)
         compressed_data = buffer.getvalue()
-        return base64.b64encode(compressed_data).decode("utf-8")
+        return pybase64.b64encode(compressed_data).decode("utf-8")
     except Exception as e:
-        print("❌ Compression Error:", str(e))
+        log.error("❌ Compression Error: %s", e)
         return None
 
 @app.route("/save-meal", methods=["POST"])
@@ -346,10 +519,10 @@ def save_meal():
         if not data:
             return jsonify({"error": "Empty request"}), 400
             
-        required = ["user_id", "dish_prediction", "image_description", "nutrition_info"]
-        missing = [k for k in required if k not in data]
-        if missing:
-            return jsonify({"error": f"Missing fields: {', '.join(missing)}"}), 400
+        try:
+            validate_meal(data)
+        except fastjsonschema.JsonSchemaException as e:
+            return jsonify({"error": f"Invalid request: {e.message}"}), 400
 
         # Process images
         image = data.get("image", None)
@@ -371,16 +544,74 @@ def save_meal():
             "contains_hardcoded_values": False
         }
 
-        result = meals_collection.insert_one(meal)
+        result = meals_fast_write_collection.insert_one(meal)
         return jsonify({
             "message": "Meal saved successfully",
             "meal_id": str(result.inserted_id)
         }), 200
         
+    except RequestEntityTooLarge:
+        raise
     except Exception as e:
-        print(f"❌ Error in save_meal: {str(e)}")
+        log.error("❌ Error in save_meal: %s", e)
         return jsonify({"error": str(e)}), 500
 
+MAX_MEALS_PAGE_SIZE = 100
+
+def user_meals_pipeline(user_id, before=None, limit=None):
+    """Aggregation pipeline that returns a user's meals already in the shape iOS expects
+
+    before is an optional (saved_at, _id) keyset cursor taken from the stored fields of the
+    last meal already seen; saved_at is "" for legacy documents that don't have the field.
+    """
+    match = {"user_id": user_id}
+    if before:
+        saved_at, meal_id = before
+        if saved_at:
+            # Older saved_at, same saved_at with a lower _id, or legacy documents (sorted last)
+            match["$or"] = [
+                {"saved_at": {"$lt": saved_at}},
+                {"saved_at": saved_at, "_id": {"$lt": meal_id}},
+                {"saved_at": None}
+            ]
+        else:
+            match["saved_at"] = None
+            match["_id"] = {"$lt": meal_id}
+
+    pipeline = [
+        {"$match": match},
+        {"$sort": {"saved_at": -1, "_id": -1}}
+    ]
+    if limit:
+        pipeline.append({"$limit": limit})
+
+    return pipeline + [
+        {"$addFields": {
+            "_id": {"$toString": "$_id"},
+            # Stored value for the pagination cursor, before saved_at is reshaped below
+            "cursor_saved_at": {"$ifNull": ["$saved_at", ""]},
+            "dish_prediction": {"$ifNull": ["$dish_prediction", {"$ifNull": ["$dish", "Unknown Dish"]}]},
+            "image_description": {"$ifNull": ["$image_description", {"$ifNull": ["$visible_ingredients", ""]}]},
+            "hidden_ingredients": {"$ifNull": ["$hidden_ingredients", ""]},
+            "nutrition_info": {"$ifNull": ["$nutrition_info", ""]},
+            "meal_type": {"$ifNull": ["$meal_type", "Lunch"]},
+            # Older documents store a "timestamp" (date or string) instead of saved_at
+            "saved_at": {"$switch": {
+                "branches": [
+                    {"case": {"$eq": [{"$type": "$timestamp"}, "date"]},
+                     "then": {"$dateToString": {"date": "$timestamp", "format": "%Y-%m-%dT%H:%M:%S.%L"}}},
+                    {"case": {"$ne": [{"$type": "$timestamp"}, "missing"]},
+                     "then": {"$toString": "$timestamp"}}
+                ],
+                "default": {"$ifNull": ["$saved_at", ""]}
+            }},
+            "image_full": {"$ifNull": ["$image_full", ""]},
+            "image_thumb": {"$ifNull": ["$image_thumb", ""]}
+        }},
+        # Remove fields that iOS doesn't expect
+        {"$project": {"timestamp": 0, "visible_ingredients": 0, "image_filename": 0, "dish": 0}}
+    ]
+
 @app.route("/user-meals", methods=["GET"])
 def get_user_meals():
     try:
@@ -388,58 +619,44 @@ def get_user_meals():
         if not user_id:
             return jsonify({"error": "Missing user_id parameter"}), 400
 
-        # Query meals for the user, sorted by date
-        meals = list(meals_collection.find(
-            {"user_id": user_id}
-        ).sort("saved_at", -1))
-        
-        # Process each meal to ensure compatibility
-        processed_meals = []
-        for meal in meals:
-            # Convert ObjectId to string
-            meal["_id"] = str(meal["_id"])
-            
-            # Handle different image storage formats
+        # Optional keyset pagination: ?limit=20&before=<X-Next-Cursor of the previous page>
+        try:
+            limit = min(int(request.args.get("limit", 0)), MAX_MEALS_PAGE_SIZE)
+        except ValueError:
+            limit = -1
+        if limit < 0:
+            return jsonify({"error": "Invalid limit parameter"}), 400
+
+        before = None
+        if request.args.get("before"):
+            # Cursor is "<saved_at>|<_id>"; _id breaks ties between meals saved in the same second
+            saved_at, _, meal_id = request.args["before"].rpartition("|")
+            if not ObjectId.is_valid(meal_id):
+                return jsonify({"error": "Invalid before parameter"}), 400
+            before = (saved_at, ObjectId(meal_id))
+
+        # Query meals for the user, sorted by date and reshaped server-side
+        processed_meals = list(meals_collection.aggregate(user_meals_pipeline(user_id, before, limit)))
+
+        # Legacy documents store raw image bytes, which the server can't base64 encode
+        cursor_saved_at = ""
+        for meal in processed_meals:
+            cursor_saved_at = meal.pop("cursor_saved_at")
             if "image" in meal and isinstance(meal["image"], bytes):
-                meal["image_thumb"] = base64.b64encode(meal["image"]).decode('utf-8')
+                meal["image_thumb"] = pybase64.b64encode(meal.pop("image")).decode('utf-8')
                 meal["image_full"] = meal["image_thumb"]
-                del meal["image"]
-            
-            # Ensure all required fields exist
-            meal.setdefault("dish_prediction", meal.get("dish", "Unknown Dish"))
-            meal.setdefault("image_description", meal.get("visible_ingredients", ""))
-            meal.setdefault("hidden_ingredients", "")
-            meal.setdefault("nutrition_info", "")
-            meal.setdefault("meal_type", "Lunch")
-            
-            # Handle timestamp/saved_at field
-            if "timestamp" in meal:
-                if hasattr(meal["timestamp"], 'isoformat'):
-                    meal["saved_at"] = meal["timestamp"].isoformat()
-                else:
-                    meal["saved_at"] = str(meal["timestamp"])
-            else:
-                meal.setdefault("saved_at", "")
-            
-            # Remove fields that iOS doesn't expect
-            fields_to_remove = ["timestamp", "visible_ingredients", "image_filename", "dish"]
-            for field in fields_to_remove:
-                meal.pop(field, None)
-            
-            # Ensure image fields exist
-            meal.setdefault("image_full", "")
-            meal.setdefault("image_thumb", "")
-            
-            processed_meals.append(meal)
 
-        print(f"🔍 Looking up meals for user_id: {user_id}")
-        print(f"📦 Total meals found: {len(processed_meals)}")
+        log.debug("🔍 Looking up meals for user_id: %s", user_id)
+        log.debug("📦 Total meals found: %d", len(processed_meals))
         
-        return jsonify(processed_meals), 200
+        response = jsonify(processed_meals)
+        # Cursor for the next page is sent as a header so the body stays a plain list
+        if limit and len(processed_meals) == limit:
+            response.headers["X-Next-Cursor"] = f"{cursor_saved_at}|{processed_meals[-1]['_id']}"
+        return response, 200
         
     except Exception as e:
-        print(f"❌ Error in get_user_meals: {str(e)}")
-        traceback.print_exc()
+        log.exception("❌ Error in get_user_meals: %s", e)
         return jsonify({"error": str(e)}), 500
 
 @app.route("/update-meal", methods=["PUT"])
@@ -478,8 +695,10 @@ def update_meal():
         else:
             return jsonify({"error": "Meal not found or no changes made"}), 404
             
+    except RequestEntityTooLarge:
+        raise
     except Exception as e:
-        print(f"❌ Error in update_meal: {str(e)}")
+        log.error("❌ Error in update_meal: %s", e)
         return jsonify({"error": str(e)}), 500
 
 @app.route("/delete-meal", methods=["DELETE"])
@@ -501,8 +720,10 @@ def delete_meal():
         else:
             return jsonify({"error": "Meal not found"}), 404
             
+    except RequestEntityTooLarge:
+        raise
     except Exception as e:
-        print(f"❌ Error in delete_meal: {str(e)}")
+        log.error("❌ Error in delete_meal: %s", e)
         return jsonify({"error": str(e)}), 500
 
 @app.route("/recalculate-nutrition", methods=["POST"])
@@ -522,8 +743,8 @@ def recalculate_nutrition():
         # Use enhanced recalculation from model_pipeline
         from model_pipeline import recalculate_nutrition_enhanced
         
-        print(f"🔄 Recalculating nutrition for user {user_id}")
-        print(f"📋 Ingredients: {ingredients[:100]}...")
+        log.debug("🔄 Recalculating nutrition for user %s", user_id)
+        log.debug("📋 Ingredients: %.100s...", ingredients)
         
         try:
             nutrition_info = recalculate_nutrition_enhanced(ingredients)
@@ -542,14 +763,16 @@ def recalculate_nutrition():
             }), 200
             
         except Exception as e:
-            print(f"❌ Recalculation error: {str(e)}")
+            log.error("❌ Recalculation error: %s", e)
             return jsonify({
                 "error": "Nutrition recalculation failed",
                 "details": str(e)
             }), 500
             
+    except RequestEntityTooLarge:
+        raise
     except Exception as e:
-        print(f"❌ Error in recalculate_nutrition: {str(e)}")
+        log.error("❌ Error in recalculate_nutrition: %s", e)
         return jsonify({"error": str(e)}), 500
     
     
@@ -562,10 +785,9 @@ def add_exercise():
         if not data:
             return jsonify({"error": "Empty request"}), 400
         
-        required = ["user_id", "exercise_type", "duration"]
-        missing = [k for k in required if k not in data]
+        missing = REQUIRED_EXERCISE_FIELDS - data.keys()
         if missing:
-            return jsonify({"error": f"Missing fields: {', '.join(missing)}"}), 400
+            return jsonify({"error": f"Missing fields: {', '.join(sorted(missing))}"}), 400
         
         exercise = {
             "user_id": data["user_id"],
@@ -577,18 +799,16 @@ def add_exercise():
             "recorded_at": data.get("recorded_at", datetime.now().isoformat())
         }
         
-        # Create exercise collection if it doesn't exist
-        exercises_collection = db["exercise"]
-        exercises_collection.create_index([("user_id", 1), ("recorded_at", -1)])
-        
-        result = exercises_collection.insert_one(exercise)
+        result = exercise_collection.insert_one(exercise)
         return jsonify({
             "message": "Exercise added successfully",
             "exercise_id": str(result.inserted_id)
         }), 200
         
+    except RequestEntityTooLarge:
+        raise
     except Exception as e:
-        print(f"❌ Error in add_exercise: {str(e)}")
+        log.error("❌ Error in add_exercise: %s", e)
         return jsonify({"error": str(e)}), 500
 
 @app.route("/user-exercise", methods=["GET"])
@@ -598,8 +818,7 @@ def get_user_exercise():
         if not user_id:
             return jsonify({"error": "Missing user_id parameter"}), 400
         
-        exercises_collection = db["exercise"]
-        exercises = list(exercises_collection.find(
+        exercises = list(exercise_collection.find(
             {"user_id": user_id}
         ).sort("recorded_at", -1))
         
@@ -609,7 +828,7 @@ def get_user_exercise():
         return jsonify(exercises), 200
         
     except Exception as e:
-        print(f"❌ Error in get_user_exercise: {str(e)}")
+        log.error("❌ Error in get_user_exercise: %s", e)
         return jsonify({"error": str(e)}), 500
 
 @app.route("/add-water", methods=["POST"])
@@ -619,10 +838,9 @@ def add_water():
         if not data:
             return jsonify({"error": "Empty request"}), 400
         
-        required = ["user_id", "amount"]
-        missing = [k for k in required if k not in data]
+        missing = REQUIRED_WATER_FIELDS - data.keys()
         if missing:
-            return jsonify({"error": f"Missing fields: {', '.join(missing)}"}), 400
+            return jsonify({"error": f"Missing fields: {', '.join(sorted(missing))}"}), 400
         
         water_entry = {
             "user_id": data["user_id"],
@@ -630,18 +848,16 @@ def add_water():
             "recorded_at": data.get("recorded_at", datetime.now().isoformat())
         }
         
-        # Create water collection if it doesn't exist
-        water_collection = db["water"]
-        water_collection.create_index([("user_id", 1), ("recorded_at", -1)])
-        
         result = water_collection.insert_one(water_entry)
         return jsonify({
             "message": "Water intake added successfully",
             "water_id": str(result.inserted_id)
         }), 200
         
+    except RequestEntityTooLarge:
+        raise
     except Exception as e:
-        print(f"❌ Error in add_water: {str(e)}")
+        log.error("❌ Error in add_water: %s", e)
         return jsonify({"error": str(e)}), 500
 
 @app.route("/user-water", methods=["GET"])
@@ -651,7 +867,6 @@ def get_user_water():
         if not user_id:
             return jsonify({"error": "Missing user_id parameter"}), 400
         
-        water_collection = db["water"]
         water_entries = list(water_collection.find(
             {"user_id": user_id}
         ).sort("recorded_at", -1))
@@ -662,7 +877,7 @@ def get_user_water():
         return jsonify(water_entries), 200
         
     except Exception as e:
-        print(f"❌ Error in get_user_water: {str(e)}")
+        log.error("❌ Error in get_user_water: %s", e)
         return jsonify({"error": str(e)}), 500
 
 @app.route("/add-weight", methods=["POST"])
@@ -672,10 +887,9 @@ def add_weight():
         if not data:
             return jsonify({"error": "Empty request"}), 400
         
-        required = ["user_id", "weight"]
-        missing = [k for k in required if k not in data]
+        missing = REQUIRED_WEIGHT_FIELDS - data.keys()
         if missing:
-            return jsonify({"error": f"Missing fields: {', '.join(missing)}"}), 400
+            return jsonify({"error": f"Missing fields: {', '.join(sorted(missing))}"}), 400
         
         weight_entry = {
             "user_id": data["user_id"],
@@ -683,18 +897,16 @@ def add_weight():
             "recorded_at": data.get("recorded_at", datetime.now().isoformat())
         }
         
-        # Create weight collection if it doesn't exist
-        weight_collection = db["weight"]
-        weight_collection.create_index([("user_id", 1), ("recorded_at", -1)])
-        
         result = weight_collection.insert_one(weight_entry)
         return jsonify({
             "message": "Weight entry added successfully",
             "weight_id": str(result.inserted_id)
         }), 200
         
+    except RequestEntityTooLarge:
+        raise
     except Exception as e:
-        print(f"❌ Error in add_weight: {str(e)}")
+        log.error("❌ Error in add_weight: %s", e)
         return jsonify({"error": str(e)}), 500
 
 @app.route("/user-weight", methods=["GET"])
@@ -704,7 +916,6 @@ def get_user_weight():
         if not user_id:
             return jsonify({"error": "Missing user_id parameter"}), 400
         
-        weight_collection = db["weight"]
         weight_entries = list(weight_collection.find(
             {"user_id": user_id}
         ).sort("recorded_at", -1))
@@ -715,7 +926,7 @@ def get_user_weight():
         return jsonify(weight_entries), 200
         
     except Exception as e:
-        print(f"❌ Error in get_user_weight: {str(e)}")
+        log.error("❌ Error in get_user_weight: %s", e)
         return jsonify({"error": str(e)}), 500
 
 @app.route("/dashboard-stats", methods=["GET"])
@@ -732,12 +943,6 @@ def get_dashboard_stats():
         week_start = today - timedelta(days=today.weekday())
         month_start = today.replace(day=1)
         
-        # Initialize collections
-        meals_collection = db["meals"]
-        water_collection = db["water"]
-        exercise_collection = db["exercise"]
-        weight_collection = db["weight"]
-        
         # Get meal stats
         meals = list(meals_collection.find({"user_id": user_id}))
         today_meals = [m for m in meals if datetime.fromisoformat(m.get("saved_at", "").replace('Z', '+00:00')).date() == today.date()]
@@ -789,7 +994,7 @@ def get_dashboard_stats():
         }), 200
         
     except Exception as e:
-        print(f"❌ Error in get_dashboard_stats: {str(e)}")
+        log.error("❌ Error in get_dashboard_stats: %s", e)
         return jsonify({"error": str(e)}), 500
 
 @app.route("/user-insights", methods=["GET"])
@@ -801,7 +1006,7 @@ def get_user_insights():
             return jsonify({"error": "Missing user_id parameter"}), 400
         
         # Get user profile for goals
-        profile = profiles_collection.find_one({"user_id": user_id})
+        profile = lookup_profile(user_id)
         if not profile:
             return jsonify({"error": "Profile not found"}), 404
         
@@ -831,7 +1036,7 @@ def get_user_insights():
         
         # Get today's water
         today_water = sum(
-            w["amount"] for w in db["water"].find({
+            w["amount"] for w in water_collection.find({
                 "user_id": user_id,
                 "recorded_at": {"$gte": today.isoformat()}
             })
@@ -839,7 +1044,7 @@ def get_user_insights():
         
         # Get today's exercise
         today_exercise = sum(
-            e["duration"] for e in db["exercise"].find({
+            e["duration"] for e in exercise_collection.find({
                 "user_id": user_id,
                 "recorded_at": {"$gte": today.isoformat()}
             })
@@ -901,7 +1106,7 @@ def get_user_insights():
         }), 200
         
     except Exception as e:
-        print(f"❌ Error in get_user_insights: {str(e)}")
+        log.error("❌ Error in get_user_insights: %s", e)
         return jsonify({"error": str(e)}), 500
 
 # Error handlers
@@ -919,8 +1124,8 @@ def payload_too_large(error):
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
-    print(f"🚀 Starting Food Analyzer Backend on port {port}")
-    print(f"✅ Based on proven working web app backend")
-    print(f"🤖 Using Gemini AI with tested prompts")
-    print(f"📱 Compatible with Swift frontend")
+    log.info("🚀 Starting Food Analyzer Backend on port %d", port)
+    log.info("✅ Based on proven working web app backend")
+    log.info("🤖 Using Gemini AI with tested prompts")
+    log.info("📱 Compatible with Swift frontend")
     app.run(host="0.0.0.0", port=port, threaded=True)
@@ -0,0 +1,24 @@
+from dotenv import load_dotenv
+from functools import lru_cache
+import os
+from pymongo import MongoClient
+
+# Load environment variables
+load_dotenv()
+
+@lru_cache(maxsize=1)
+def get_client():
+    """One MongoDB client per process, shared by app.py and model_pipeline.py"""
+    return MongoClient(
+        os.getenv("MONGO_URI"),
+        maxPoolSize=50,
+        minPoolSize=5,
+        maxIdleTimeMS=30000,
+        serverSelectionTimeoutMS=2000,
+        socketTimeoutMS=10000,
+        compressors="zstd"
+    )
+
+def get_db():
+    """Application database on the shared client"""
+    return get_client()[os.getenv("MONGO_DB", "food-app-swift")]
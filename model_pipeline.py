@@ -1,235 +1,474 @@
 from PIL import Image
+import numpy as np
 import google.generativeai as genai
-import base64
+from google.api_core import exceptions as google_exceptions
+import hashlib
+import logging
 import os
+import random
 import re
 import time
 from datetime import datetime
 from dotenv import load_dotenv
-from pymongo import MongoClient
+from db import get_db
+from pymongo.write_concern import WriteConcern
 from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+import threading
+from cachetools import TTLCache
 
 # Load environment variables
 load_dotenv()
 
+# Records go through the queued handlers configured in app.py
+log = logging.getLogger("model_pipeline")
+
 # Gemini API Setup
 GEN_API_KEY = os.getenv("GEMINI_API_KEY")
 if not GEN_API_KEY:
     raise ValueError("GEMINI_API_KEY is not set in environment variables.")
 
-genai.configure(api_key=GEN_API_KEY)
+# REST transport goes through gevent-patched sockets (gRPC would block the gevent hub)
+genai.configure(api_key=GEN_API_KEY, transport="rest")
 gemini_model = genai.GenerativeModel('gemini-1.5-flash')
 
-# MongoDB Setup
-mongo_uri = os.getenv("MONGO_URI")
-mongo_db = os.getenv("MONGO_DB", "food-app-swift")
-client = MongoClient(mongo_uri)
-db = client[mongo_db]
-meals_collection = db["meals"]
+# Open the keep-alive HTTPS connection now so the first analysis doesn't pay the TLS handshake.
+# count_tokens goes through the model's own generative client, the one generate_content reuses
+# (genai.get_model would warm a separate model-service client instead).
+try:
+    gemini_model.count_tokens("warm-up")
+except Exception as e:
+    log.warning("⚠️ Gemini warm-up failed: %s", e)
+
+# MongoDB Setup (shared process-wide client from db.py)
+# Analysis results keyed by image content hash, expired by MongoDB after 30 days
+# Cache writes are acknowledged but not journaled - losing one only costs a re-analysis
+analysis_cache_collection = get_db()["analysis_cache"].with_options(
+    write_concern=WriteConcern(w=1, j=False))
+# The cache is best-effort, so an unreachable MongoDB must not stop this module from importing
+try:
+    analysis_cache_collection.create_index("createdAt", expireAfterSeconds=30 * 24 * 3600)
+    analysis_cache_collection.create_index([("user_id", 1), ("phash", 1)])
+except Exception as e:
+    log.warning("⚠️ Analysis cache index setup failed: %s", e)
+
+# Recent text-only Gemini replies keyed by a hash of the prompt, so repeats skip the API call
+gemini_response_cache = TTLCache(maxsize=512, ttl=600)
+gemini_response_cache_lock = threading.Lock()
+
+# After this many Gemini API failures in a row, fail fast for a while instead of calling it
+GEMINI_BREAKER_MAX_FAILURES = 5
+GEMINI_BREAKER_RESET_SECONDS = 30
+gemini_breaker_state = {"failures": 0, "open_until": 0.0}
+gemini_breaker_lock = threading.Lock()
+
+# Rate limits and server-side hiccups are retried with jittered exponential backoff
+TRANSIENT_GEMINI_ERRORS = (
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.InternalServerError,
+)
+GEMINI_MAX_RETRIES = 2
+GEMINI_RETRY_BASE_SECONDS = 1
+GEMINI_RETRY_CAP_SECONDS = 8
+
+# Recent analyses per user keyed by a 64-bit perceptual hash, for recompressed re-uploads
+similar_analysis_cache = TTLCache(maxsize=1024, ttl=3600)
+similar_analysis_cache_lock = threading.Lock()
+
+# Max differing hash bits for two uploads to count as the same photo
+SIMILAR_IMAGE_MAX_DISTANCE = 4
+
+# Prefixes Gemini sometimes puts before the dish list, e.g. "Dishes:" or "Food items:"
+DISH_PREFIX_RE = re.compile(r'^(?:(?:dishes|food items|items|dish|food):\s*)+', re.IGNORECASE)
+
+# A whole line with exactly four |-separated columns
+INGREDIENT_LINE_RE = re.compile(r'^[^|\r\n]*\|[^|\r\n]*\|[^|\r\n]*\|[^|\r\n]*?\r?$', re.MULTILINE)
+
+# Threads for Gemini fallback calls that can run side by side
+followup_executor = ThreadPoolExecutor(max_workers=8)
+
+# Used in the nutrition prompt when hidden ingredients are estimated concurrently
+HIDDEN_NOT_LISTED = "Not listed - include typical cooking oils, seasonings and sauces for these dishes"
+
+# Used when follow-up calls start from the dish names before the visible ingredients are known
+VISIBLE_NOT_LISTED = "Not listed yet - assume a typical single serving of each dish"
+
+# Single image call returning the dish list, visible/hidden ingredients and nutrition
+MEAL_ANALYSIS_PROMPT = (
+    "You are a comprehensive food analyst and nutritionist. Look at this image and identify ALL food items present.\n\n"
+    "Return exactly three sections, each starting with its marker on its own line:\n"
+    "===DISH===\n===HIDDEN===\n===NUTRITION===\n\n"
+    "SECTION ===DISH===:\n"
+    "First line: List all dishes/food items you see (e.g., 'Chicken curry, basmati rice, naan bread, mixed salad')\n"
+    "Then list ALL VISIBLE ingredients from ALL dishes/items, one per line:\n"
+    "Ingredient | Quantity Number | Unit | Which dish/item it's from\n"
+    "Include vegetables, proteins, grains/starches, garnishes, toppings, bread and salad ingredients you can see.\n"
+    "DO NOT include cooking oils, salt, spices, or marinades (these are hidden).\n\n"
+    "SECTION ===HIDDEN===:\n"
+    "List the HIDDEN ingredients likely used to prepare ALL the dishes/items: cooking oils/fats, basic seasonings, "
+    "cooking liquids, absorbed marinades or sauces, binding agents, mixed-in spices and herbs, yeast or baking powder.\n"
+    "Ingredient | Quantity Number | Unit | Used for which dish/purpose\n\n"
+    "SECTION ===NUTRITION===:\n"
+    "Calculate the TOTAL nutritional breakdown for the ENTIRE MEAL (all dishes combined, visible and hidden ingredients), "
+    "for one person eating all the food shown, with realistic portion sizes.\n"
+    "Nutrient | Value | Unit | Reasoning\n"
+    "Include these nutrients: Calories, Protein, Fat, Carbohydrates, Fiber, Sugar, Sodium.\n\n"
+    "Quantity Number and Value must be numeric only.\n\n"
+    "Example:\n"
+    "===DISH===\n"
+    "Chicken curry, basmati rice\n"
+    "Chicken pieces | 150 | g | Main curry dish\n"
+    "Basmati rice | 200 | g | Side dish\n"
+    "===HIDDEN===\n"
+    "Cooking oil | 3 | tbsp | Used for curry and rice preparation\n"
+    "Salt | 2 | tsp | Seasoning for curry and rice\n"
+    "===NUTRITION===\n"
+    "Calories | 700 | kcal | Curry (400) + rice (300)\n"
+    "Protein | 40 | g | From chicken in curry and grains"
+)
 
-def encode_image(image_path):
-    """Encode image to base64"""
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode("utf-8")
+# Fallback image call for the dish list and visible ingredients only
+DESCRIPTION_PROMPT = (
+    "You are a comprehensive food analyst. Look at this image and identify ALL food items present.\n\n"
+    "INSTRUCTIONS:\n"
+    "1. First line: List all dishes/food items you see (e.g., 'Chicken curry, basmati rice, naan bread, mixed salad')\n"
+    "2. Then list ALL visible ingredients from ALL dishes/items in the image\n\n"
+    "ANALYZE EVERYTHING:\n"
+    "- Main dishes (curries, stir-fries, pasta, etc.)\n"
+    "- Side dishes (rice, bread, salads, etc.)\n"
+    "- Beverages (if visible)\n"
+    "- Snacks or appetizers\n"
+    "- Desserts\n"
+    "- Condiments or sauces in separate containers\n\n"
+    "Format each VISIBLE ingredient from ALL items:\n"
+    "Ingredient | Quantity Number | Unit | Which dish/item it's from\n\n"
+    "VISIBLE means you can actually see it:\n"
+    "- Vegetables you can see in any dish\n"
+    "- Proteins visible in any dish\n"
+    "- Grains/starches you can see\n"
+    "- Visible garnishes, herbs, or toppings on any item\n"
+    "- Bread, naan, or other baked items\n"
+    "- Salad ingredients you can identify\n\n"
+    "DO NOT include cooking oils, salt, spices, or marinades (these are hidden).\n"
+    "Quantity Number must be numeric only.\n"
+    "Be thorough - don't miss any food items in the image.\n\n"
+    "Example for multiple dishes:\n"
+    "Chicken pieces | 150 | g | Main curry dish\n"
+    "Basmati rice | 200 | g | Side dish\n"
+    "Naan bread | 1 | piece | Bread item\n"
+    "Lettuce | 50 | g | Salad\n"
+    "Tomatoes | 30 | g | Salad"
+)
 
-def analyze_image_with_gemini(image_path):
-    """Analyze image with Gemini - based on working web app code"""
+# Follow-up text call for hidden ingredients
+HIDDEN_INGREDIENTS_PROMPT = (
+    "You are a recipe analyst identifying hidden/non-visible ingredients.\n\n"
+    "DISHES/ITEMS: {dish_names}\n"
+    "VISIBLE INGREDIENTS (what can be seen in the image):\n{visible_ingredients}\n\n"
+    "Identify the HIDDEN ingredients likely used for ALL the dishes/items shown.\n"
+    "Consider what would be needed to prepare each dish/item.\n\n"
+    "HIDDEN INGREDIENTS are typically:\n"
+    "- Cooking oils/fats (olive oil, butter, vegetable oil, ghee)\n"
+    "- Basic seasonings (salt, black pepper, garlic powder)\n"
+    "- Cooking liquids (water, broth, wine used in cooking)\n"
+    "- Marinades or sauces that are absorbed/mixed in\n"
+    "- Binding agents (eggs in batter, flour for coating)\n"
+    "- Spices and herbs that are mixed in (not visible as garnish)\n"
+    "- Yeast or baking powder (for bread items)\n\n"
+    "For multiple dishes, consider what each would need:\n"
+    "- Curries: oil, spices, salt, onions (if not visible)\n"
+    "- Rice: water, salt, oil/butter\n"
+    "- Bread: flour, yeast, oil, salt (if not visible)\n"
+    "- Salads: dressing, oil, vinegar\n\n"
+    "Format each hidden ingredient:\n"
+    "Ingredient | Quantity Number | Unit | Used for which dish/purpose\n\n"
+    "Examples:\n"
+    "Cooking oil | 3 | tbsp | Used for curry and rice preparation\n"
+    "Salt | 2 | tsp | Seasoning for curry and rice\n"
+    "Cumin powder | 1 | tsp | Spice for curry dish\n"
+    "Olive oil | 1 | tbsp | Salad dressing\n\n"
+    "Quantity Number must be numeric only.\n"
+    "Include ingredients for ALL dishes mentioned."
+)
+
+# Follow-up text call for total meal nutrition
+NUTRITION_PROMPT = (
+    "You are a nutritionist calculating nutrition for ALL food items shown.\n\n"
+    "COMPLETE MEAL ANALYSIS:\n{all_ingredients}\n\n"
+    "Calculate the TOTAL nutritional breakdown for the ENTIRE MEAL (all dishes combined).\n"
+    "This represents what one person would consume if they ate all the food shown.\n\n"
+    "Output each nutrient on a new line in this exact format:\n"
+    "Nutrient | Value | Unit | Reasoning\n"
+    "Value must be a numeric value only.\n\n"
+    "Examples:\n"
+    "Calories | 850 | kcal | Curry (400) + rice (300) + bread (150)\n"
+    "Protein | 45 | g | From chicken in curry and grains\n"
+    "Fat | 25 | g | From cooking oil, meat, and dairy\n\n"
+    "Include these nutrients: Calories, Protein, Fat, Carbohydrates, Fiber, Sugar, Sodium.\n"
+    "Consider ALL items shown - main dishes, sides, beverages, etc.\n"
+    "Account for both visible and hidden ingredients in your calculations.\n"
+    "Provide realistic portion sizes for a typical meal."
+)
+
+# Nutrition for a user-edited ingredient list
+RECALCULATE_NUTRITION_PROMPT = (
+    "You are a nutritionist.\n"
+    "Calculate the exact nutritional values for these ingredients:\n\n{ingredients_text}\n\n"
+    "Output each nutrient on a new line in this exact format:\n"
+    "Nutrient | Value | Unit | Reasoning\n"
+    "Value must be a numeric value only.\n"
+    "Include at least: Calories, Protein, Fat, Carbohydrates, Fiber, Sugar, Sodium.\n"
+    "Base calculations on the specific quantities provided.\n"
+    "Be strict with the format."
+)
+
+def prepare_image_for_gemini(image, image_bytes):
+    """Resize and re-encode an opened (not yet decoded) image for Gemini"""
+    # Gemini rescales images to 768x768 tiles and charges the same tokens either way
+    max_size = (768, 768)
+    
+    # Small RGB JPEGs are already what Gemini gets - send the upload as-is
+    if image.format == 'JPEG' and image.mode == 'RGB' and max(image.size) <= max(max_size):
+        return image_bytes
+    
+    # Resize if too large; for JPEGs, draft() lets libjpeg decode at 1/2-1/8 scale first
+    image.draft('RGB', max_size)
+    
+    # Convert to RGB if needed - before resizing, so palette images are filtered properly
+    # and RGBA isn't premultiplied and unpremultiplied around the resize
+    if image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    
+    # Gemini re-tokenizes the image, so Lanczos quality is wasted here; bicubic is
+    # only worth it for larger downscales, where bilinear would start to alias
+    ratio = max(image.size) / max(max_size)
+    resample = Image.Resampling.BILINEAR if ratio < 1.5 else Image.Resampling.BICUBIC
+    image.thumbnail(max_size, resample, reducing_gap=3.0)
+    
+    # Re-encode the optimized version in memory; the SDK takes raw bytes, no base64 needed
+    buffer = BytesIO()
+    image.save(buffer, 'JPEG', quality=80, optimize=True, progressive=True, subsampling=2)
+    return buffer.getvalue()
+
+def record_gemini_failure():
+    """Count a transient Gemini failure and open the breaker after too many in a row"""
+    with gemini_breaker_lock:
+        gemini_breaker_state["failures"] += 1
+        if gemini_breaker_state["failures"] >= GEMINI_BREAKER_MAX_FAILURES:
+            log.warning("⚠️ Gemini failing, pausing calls for %ds", GEMINI_BREAKER_RESET_SECONDS)
+            gemini_breaker_state["open_until"] = time.monotonic() + GEMINI_BREAKER_RESET_SECONDS
+            gemini_breaker_state["failures"] = 0
+
+def call_gemini(contents, **kwargs):
+    """gemini_model.generate_content behind a circuit breaker, retrying transient errors"""
+    with gemini_breaker_lock:
+        if time.monotonic() < gemini_breaker_state["open_until"]:
+            raise Exception("Gemini is temporarily unavailable, please try again shortly")
+    
+    for attempt in range(GEMINI_MAX_RETRIES + 1):
+        try:
+            response = gemini_model.generate_content(contents, **kwargs)
+            break
+        except TRANSIENT_GEMINI_ERRORS as e:
+            if attempt == GEMINI_MAX_RETRIES:
+                record_gemini_failure()
+                raise
+            # Full jitter so concurrent requests don't retry in lock-step
+            delay = random.uniform(0, min(GEMINI_RETRY_CAP_SECONDS, GEMINI_RETRY_BASE_SECONDS * 2 ** attempt))
+            log.warning("⚠️ Gemini transient error (%s), retrying in %.1fs", type(e).__name__, delay)
+            time.sleep(delay)
+        except Exception:
+            # Bad requests, auth errors etc. won't succeed on retry, and they say nothing about
+            # Gemini's health - one user's bad upload must not trip the breaker for everyone
+            raise
+    
+    with gemini_breaker_lock:
+        gemini_breaker_state["failures"] = 0
+    return response
+
+def generate_content_cached(prompt):
+    """Text-only Gemini call returning the reply text, memoized in-process
+
+    Image prompts aren't cached here - analysis_cache already covers them.
+    Only replies with formatted rows are kept, so a refusal or malformed reply isn't replayed.
+    """
+    key = hashlib.blake2b(prompt.encode(), digest_size=16).digest()
+    
+    with gemini_response_cache_lock:
+        cached = gemini_response_cache.get(key)
+    if cached:
+        return cached
+    
+    response = call_gemini(prompt)
+    text = response.text if response else ""
+    
+    if formatted_lines(text):
+        with gemini_response_cache_lock:
+            gemini_response_cache[key] = text
+    return text
+
+def analyze_meal_with_gemini(image_data):
+    """Single Gemini call returning dishes, visible/hidden ingredients and nutrition"""
     try:
-        # Optimize image before sending
-        image = Image.open(image_path)
-        
-        # Resize if too large
-        max_size = (1024, 1024)
-        image.thumbnail(max_size, Image.Resampling.LANCZOS)
-        
-        # Convert to RGB if needed
-        if image.mode not in ('RGB', 'L'):
-            image = image.convert('RGB')
+        prompt = MEAL_ANALYSIS_PROMPT
         
-        # Save optimized version
-        optimized_path = image_path.replace('.png', '_opt.jpg')
-        image.save(optimized_path, 'JPEG', quality=85)
-        
-        # Encode optimized image
-        image_data = encode_image(optimized_path)
-        
-        # Clean up optimized file
-        try:
-            os.remove(optimized_path)
-        except:
-            pass
+        log.debug("🔍 Analyzing meal with a single Gemini call...")
         
-        # Enhanced prompt for analyzing ALL dishes/items in the image
-        prompt = (
-            "You are a comprehensive food analyst. Look at this image and identify ALL food items present.\n\n"
-            "INSTRUCTIONS:\n"
-            "1. First line: List all dishes/food items you see (e.g., 'Chicken curry, basmati rice, naan bread, mixed salad')\n"
-            "2. Then list ALL visible ingredients from ALL dishes/items in the image\n\n"
-            "ANALYZE EVERYTHING:\n"
-            "- Main dishes (curries, stir-fries, pasta, etc.)\n"
-            "- Side dishes (rice, bread, salads, etc.)\n"
-            "- Beverages (if visible)\n"
-            "- Snacks or appetizers\n"
-            "- Desserts\n"
-            "- Condiments or sauces in separate containers\n\n"
-            "Format each VISIBLE ingredient from ALL items:\n"
-            "Ingredient | Quantity Number | Unit | Which dish/item it's from\n\n"
-            "VISIBLE means you can actually see it:\n"
-            "- Vegetables you can see in any dish\n"
-            "- Proteins visible in any dish\n"
-            "- Grains/starches you can see\n"
-            "- Visible garnishes, herbs, or toppings on any item\n"
-            "- Bread, naan, or other baked items\n"
-            "- Salad ingredients you can identify\n\n"
-            "DO NOT include cooking oils, salt, spices, or marinades (these are hidden).\n"
-            "Quantity Number must be numeric only.\n"
-            "Be thorough - don't miss any food items in the image.\n\n"
-            "Example for multiple dishes:\n"
-            "Chicken pieces | 150 | g | Main curry dish\n"
-            "Basmati rice | 200 | g | Side dish\n"
-            "Naan bread | 1 | piece | Bread item\n"
-            "Lettuce | 50 | g | Salad\n"
-            "Tomatoes | 30 | g | Salad"
-        )
-        
-        print("🔍 Analyzing image with Gemini...")
-        
-        response = gemini_model.generate_content([
+        response = call_gemini([
             prompt,
             {"mime_type": "image/jpeg", "data": image_data}
         ])
+        text = response.text if response else ""
+        
+        if text:
+            log.debug("✅ Gemini meal analysis successful")
+            return parse_sectioned_response(text)
+        else:
+            raise Exception("Empty response from Gemini")
+            
+    except Exception as e:
+        log.error("❌ Gemini meal analysis error: %s", e)
+        return {"description": "", "hidden": "", "nutrition": ""}
+
+def parse_sectioned_response(text):
+    """Split a ===DISH===/===HIDDEN===/===NUTRITION=== response into its sections"""
+    _, _, rest = text.partition("===DISH===")
+    description, _, rest = rest.partition("===HIDDEN===")
+    hidden, _, nutrition = rest.partition("===NUTRITION===")
+    
+    return {
+        "description": description.strip(),
+        "hidden": "\n".join(formatted_lines(hidden)),
+        "nutrition": nutrition.strip()
+    }
+
+def formatted_lines(text):
+    """Stripped lines with at least four |-separated columns"""
+    # Counting pipes avoids building a split list for every line
+    return [line.strip() for line in text.splitlines() if line.count('|') >= 3]
+
+def analyze_image_with_gemini(image_data, on_dish_names=None):
+    """Analyze image with Gemini - based on working web app code
+
+    If on_dish_names is given, the response is streamed and the callback gets the
+    dish names as soon as the first line arrives, while the ingredients keep streaming.
+    """
+    try:
+        # Enhanced prompt for analyzing ALL dishes/items in the image
+        prompt = DESCRIPTION_PROMPT
+        
+        log.debug("🔍 Analyzing image with Gemini...")
+        
+        if on_dish_names:
+            text = stream_description(prompt, image_data, on_dish_names)
+        else:
+            response = call_gemini([
+                prompt,
+                {"mime_type": "image/jpeg", "data": image_data}
+            ])
+            text = response.text if response else ""
         
-        if response and response.text:
-            print("✅ Gemini analysis successful")
-            return response.text
+        if text:
+            log.debug("✅ Gemini analysis successful")
+            return text
         else:
             raise Exception("Empty response from Gemini")
             
     except Exception as e:
-        print(f"❌ Gemini analysis error: {str(e)}")
+        log.error("❌ Gemini analysis error: %s", e)
         return f"Gemini error: {str(e)}"
 
-def extract_ingredients_only(description):
-    """Extract only ingredient lines from description"""
-    lines = description.splitlines()
-    ingredients = []
-    for line in lines[1:]:  # Skip first line (dish name)
-        if '|' in line and len(line.split('|')) == 4:
-            ingredients.append(line.strip())
-    return "\n".join(ingredients)
+def stream_description(prompt, image_data, on_dish_names):
+    """Stream a description response, reporting the dish names once the first line is complete"""
+    response = call_gemini([
+        prompt,
+        {"mime_type": "image/jpeg", "data": image_data}
+    ], stream=True)
+    
+    chunks = []
+    for chunk in response:
+        chunks.append(chunk.text)
+        if on_dish_names:
+            text = "".join(chunks).lstrip()
+            if '\n' in text:
+                on_dish_names(extract_dish_name(text))
+                on_dish_names = None
+    
+    return "".join(chunks)
+
+def parse_description(description):
+    """Split a description into (dish names, ingredient lines) in one pass"""
+    first_line, _, body = description.strip().partition('\n')
+    ingredients = "\n".join(match.group(0).strip() for match in INGREDIENT_LINE_RE.finditer(body))
+    return extract_dish_name(first_line), ingredients
 
 def search_hidden_ingredients(dish_names, visible_ingredients):
-    """Find hidden ingredients based on ALL dishes and visible ingredients"""
-    prompt = (
-        f"You are a recipe analyst identifying hidden/non-visible ingredients.\n\n"
-        f"DISHES/ITEMS: {dish_names}\n"
-        f"VISIBLE INGREDIENTS (what can be seen in the image):\n{visible_ingredients}\n\n"
-        "Identify the HIDDEN ingredients likely used for ALL the dishes/items shown.\n"
-        "Consider what would be needed to prepare each dish/item.\n\n"
-        "HIDDEN INGREDIENTS are typically:\n"
-        "- Cooking oils/fats (olive oil, butter, vegetable oil, ghee)\n"
-        "- Basic seasonings (salt, black pepper, garlic powder)\n"
-        "- Cooking liquids (water, broth, wine used in cooking)\n"
-        "- Marinades or sauces that are absorbed/mixed in\n"
-        "- Binding agents (eggs in batter, flour for coating)\n"
-        "- Spices and herbs that are mixed in (not visible as garnish)\n"
-        "- Yeast or baking powder (for bread items)\n\n"
-        "For multiple dishes, consider what each would need:\n"
-        "- Curries: oil, spices, salt, onions (if not visible)\n"
-        "- Rice: water, salt, oil/butter\n"
-        "- Bread: flour, yeast, oil, salt (if not visible)\n"
-        "- Salads: dressing, oil, vinegar\n\n"
-        "Format each hidden ingredient:\n"
-        "Ingredient | Quantity Number | Unit | Used for which dish/purpose\n\n"
-        "Examples:\n"
-        "Cooking oil | 3 | tbsp | Used for curry and rice preparation\n"
-        "Salt | 2 | tsp | Seasoning for curry and rice\n"
-        "Cumin powder | 1 | tsp | Spice for curry dish\n"
-        "Olive oil | 1 | tbsp | Salad dressing\n\n"
-        "Quantity Number must be numeric only.\n"
-        "Include ingredients for ALL dishes mentioned."
-    )
+    """Find hidden ingredients based on ALL dishes and visible ingredients
+
+    Returns (text, from_gemini) - from_gemini is False when the text is the default fallback.
+    """
+    prompt = HIDDEN_INGREDIENTS_PROMPT.format(dish_names=dish_names, visible_ingredients=visible_ingredients)
     
     try:
-        print("🔍 Searching for hidden ingredients for all dishes...")
-        response = gemini_model.generate_content(prompt)
+        log.debug("🔍 Searching for hidden ingredients for all dishes...")
+        text = generate_content_cached(prompt)
         
-        if response and response.text:
+        if text:
             # Clean up the response
-            lines = response.text.strip().split('\n')
-            formatted_lines = []
-            
-            for line in lines:
-                line = line.strip()
-                if '|' in line and len(line.split('|')) >= 4:
-                    formatted_lines.append(line)
+            hidden_lines = formatted_lines(text)
             
-            if formatted_lines:
-                result = '\n'.join(formatted_lines)
-                print(f"✅ Hidden ingredients found: {len(formatted_lines)} items for all dishes")
-                return result
+            if hidden_lines:
+                result = '\n'.join(hidden_lines)
+                log.debug("✅ Hidden ingredients found: %d items for all dishes", len(hidden_lines))
+                return result, True
             else:
-                print("⚠️ No properly formatted hidden ingredients found, using defaults")
-                return "Cooking oil | 2 | tbsp | Used for cooking dishes\nSalt | 1 | tsp | Basic seasoning for dishes\nWater | 250 | ml | Used for cooking rice/grains"
+                log.warning("⚠️ No properly formatted hidden ingredients found, using defaults")
+                return "Cooking oil | 2 | tbsp | Used for cooking dishes\nSalt | 1 | tsp | Basic seasoning for dishes\nWater | 250 | ml | Used for cooking rice/grains", False
         else:
-            print("⚠️ Empty response for hidden ingredients")
-            return "Cooking oil | 2 | tbsp | Used for cooking dishes\nSalt | 1 | tsp | Basic seasoning for dishes"
+            log.warning("⚠️ Empty response for hidden ingredients")
+            return "Cooking oil | 2 | tbsp | Used for cooking dishes\nSalt | 1 | tsp | Basic seasoning for dishes", False
             
     except Exception as e:
-        print(f"❌ Hidden ingredients error: {str(e)}")
-        return "Cooking oil | 2 | tbsp | Used for cooking dishes\nSalt | 1 | tsp | Basic seasoning for dishes"
+        log.error("❌ Hidden ingredients error: %s", e)
+        return "Cooking oil | 2 | tbsp | Used for cooking dishes\nSalt | 1 | tsp | Basic seasoning for dishes", False
+
+def estimate_nutrition_from_ingredients(dish_names, visible_ingredients, hidden_ingredients=HIDDEN_NOT_LISTED):
+    """Estimate nutrition based on ALL dishes and ingredients
 
-def estimate_nutrition_from_ingredients(dish_names, visible_ingredients, hidden_ingredients):
-    """Estimate nutrition based on ALL dishes and ingredients"""
+    Returns (text, from_gemini) - from_gemini is False when the text is an error message.
+    """
     
     # Combine both visible and hidden ingredients for nutrition calculation
     all_ingredients = f"DISHES/ITEMS: {dish_names}\n\nVISIBLE INGREDIENTS:\n{visible_ingredients}\n\nHIDDEN INGREDIENTS:\n{hidden_ingredients}"
     
-    prompt = (
-        f"You are a nutritionist calculating nutrition for ALL food items shown.\n\n"
-        f"COMPLETE MEAL ANALYSIS:\n{all_ingredients}\n\n"
-        "Calculate the TOTAL nutritional breakdown for the ENTIRE MEAL (all dishes combined).\n"
-        "This represents what one person would consume if they ate all the food shown.\n\n"
-        "Output each nutrient on a new line in this exact format:\n"
-        "Nutrient | Value | Unit | Reasoning\n"
-        "Value must be a numeric value only.\n\n"
-        "Examples:\n"
-        "Calories | 850 | kcal | Curry (400) + rice (300) + bread (150)\n"
-        "Protein | 45 | g | From chicken in curry and grains\n"
-        "Fat | 25 | g | From cooking oil, meat, and dairy\n\n"
-        "Include these nutrients: Calories, Protein, Fat, Carbohydrates, Fiber, Sugar, Sodium.\n"
-        "Consider ALL items shown - main dishes, sides, beverages, etc.\n"
-        "Account for both visible and hidden ingredients in your calculations.\n"
-        "Provide realistic portion sizes for a typical meal."
-    )
+    prompt = NUTRITION_PROMPT.format(all_ingredients=all_ingredients)
     
     try:
-        print("🔍 Calculating nutrition for complete meal...")
-        response = gemini_model.generate_content(prompt)
+        log.debug("🔍 Calculating nutrition for complete meal...")
+        text = generate_content_cached(prompt)
         
-        if response and response.text:
-            print("✅ Complete meal nutrition calculation done")
-            return response.text
+        if text:
+            log.debug("✅ Complete meal nutrition calculation done")
+            return text, True
         else:
-            return "Nutrition estimation failed"
+            return "Nutrition estimation failed", False
             
     except Exception as e:
-        print(f"❌ Nutrition estimation error: {str(e)}")
-        return f"Nutrition estimation error: {str(e)}"
+        log.error("❌ Nutrition estimation error: %s", e)
+        return f"Nutrition estimation error: {str(e)}", False
 
 def extract_dish_name(description):
     """Extract dish name(s) from description - handles multiple dishes"""
     # Get first line which should contain all dishes
-    first_line = description.strip().split('\n')[0]
+    first_line = description.strip().partition('\n')[0]
     
     # Clean up the first line
     dish_names = first_line.strip()
     
     # Remove any prefixes like "Dishes:" or "Food items:"
-    prefixes_to_remove = ["dishes:", "food items:", "items:", "dish:", "food:"]
-    for prefix in prefixes_to_remove:
-        if dish_names.lower().startswith(prefix):
-            dish_names = dish_names[len(prefix):].strip()
+    dish_names = DISH_PREFIX_RE.sub('', dish_names, count=1)
     
     # If it's a single dish, capitalize properly
     if ',' not in dish_names and ' and ' not in dish_names:
@@ -238,82 +477,196 @@ def extract_dish_name(description):
     # For multiple dishes, return as is (already formatted)
     return dish_names
 
-def parse_to_dict(text):
-    """Parse formatted text to dictionary"""
-    data_dict = {}
-    for line in text.splitlines():
-        parts = [p.strip() for p in line.split('|')]
-        if len(parts) == 4:
-            try:
-                # Try to convert to numeric value
-                numeric_value = float(parts[1]) if '.' in parts[1] else int(parts[1])
-                data_dict[parts[0]] = {
-                    "Quantity Number/Value": numeric_value,
-                    "Unit": parts[2],
-                    "Reasoning": parts[3]
-                }
-            except ValueError:
-                continue
-    return data_dict
-
-def full_image_analysis(image_path, user_id):
-    """Main function for complete image analysis - based on working web app"""
+def image_cache_key(image_bytes):
+    """Content hash of the uploaded image (BLAKE2b, not used for security)"""
+    return hashlib.blake2b(image_bytes, digest_size=16).hexdigest()
+
+def get_cached_analysis(cache_key):
+    """Return a previously stored analysis for this cache key, if any"""
+    try:
+        cached = analysis_cache_collection.find_one({"_id": cache_key}, {"result": 1})
+        return cached["result"] if cached else None
+    except Exception as e:
+        log.warning("⚠️ Analysis cache lookup failed: %s", e)
+        return None
+
+def get_cached_analysis_by_phash(user_id, image_hash):
+    """Return a stored analysis of an image with the same perceptual hash for this user, if any"""
+    try:
+        cached = analysis_cache_collection.find_one(
+            {"user_id": user_id, "phash": format(image_hash, "016x")}, {"result": 1})
+        return cached["result"] if cached else None
+    except Exception as e:
+        log.warning("⚠️ Analysis cache lookup failed: %s", e)
+        return None
+
+def store_cached_analysis(cache_key, result, user_id=None, image_hash=None):
+    """Store a successful analysis so re-uploads of the same image skip Gemini"""
+    document = {"result": result, "createdAt": datetime.utcnow()}
+    if image_hash is not None:
+        # Hex string: BSON integers are signed and the hash uses all 64 bits
+        document["user_id"] = user_id
+        document["phash"] = format(image_hash, "016x")
+    try:
+        analysis_cache_collection.replace_one({"_id": cache_key}, document, upsert=True)
+    except Exception as e:
+        log.warning("⚠️ Analysis cache store failed: %s", e)
+
+def perceptual_hash(image_data):
+    """64-bit difference hash of a JPEG; survives recompression and small resizes"""
+    with Image.open(BytesIO(image_data)) as image:
+        image.draft('L', (72, 64))
+        pixels = np.asarray(image.convert('L').resize((9, 8), Image.Resampling.BILINEAR), dtype=np.int16)
+    # One bit per pixel: is it brighter than its left neighbour
+    return int.from_bytes(np.packbits(pixels[:, 1:] > pixels[:, :-1]).tobytes(), 'big')
+
+def get_similar_analysis(user_id, image_hash):
+    """Return this user's recent analysis of a near-identical image, if any"""
+    with similar_analysis_cache_lock:
+        for (cached_user_id, cached_hash), result in similar_analysis_cache.items():
+            if cached_user_id == user_id and (cached_hash ^ image_hash).bit_count() <= SIMILAR_IMAGE_MAX_DISTANCE:
+                return dict(result)
+    return None
+
+def store_similar_analysis(user_id, image_hash, result):
+    """Remember an analysis under the image's perceptual hash"""
+    with similar_analysis_cache_lock:
+        similar_analysis_cache[(user_id, image_hash)] = dict(result)
+
+def full_image_analysis(image_bytes, user_id, image=None):
+    """Main function for complete image analysis - based on working web app
+
+    image is the already opened upload from validate_image_for_analysis, if the caller has it.
+    """
     try:
         start_time = time.time()
         
-        print(f"🤖 Starting image analysis for user: {user_id}")
-        print(f"📸 Image: {image_path}")
+        log.debug("🤖 Starting image analysis for user: %s", user_id)
+        log.debug("📸 Image size: %d bytes", len(image_bytes))
+        
+        # Re-uploads of the same photo reuse the stored analysis
+        cache_key = image_cache_key(image_bytes)
+        cached_result = get_cached_analysis(cache_key)
+        if cached_result:
+            log.debug("✅ Returning cached analysis")
+            cached_result['analysis_time'] = time.time() - start_time
+            cached_result['user_id'] = user_id
+            return cached_result
         
-        # Step 1: Get basic description and dish name
-        gemini_description = analyze_image_with_gemini(image_path)
+        # Resize/re-encode once and reuse the JPEG bytes for every Gemini call
+        if image is None:
+            image = Image.open(BytesIO(image_bytes))
+        image_data = prepare_image_for_gemini(image, image_bytes)
         
-        if "Gemini error" in gemini_description:
-            raise Exception(f"Gemini analysis failed: {gemini_description}")
+        # A recompressed or resized re-upload of a recent photo reuses that analysis
+        image_hash = perceptual_hash(image_data)
+        similar_result = get_similar_analysis(user_id, image_hash) or get_cached_analysis_by_phash(user_id, image_hash)
+        if similar_result:
+            log.debug("✅ Returning analysis of a near-identical image")
+            store_cached_analysis(cache_key, similar_result, user_id, image_hash)
+            similar_result['analysis_time'] = time.time() - start_time
+            similar_result['user_id'] = user_id
+            return similar_result
         
-        # Step 2: Extract dish names (could be multiple)
-        dish_names = extract_dish_name(gemini_description)
+        # Step 1: One Gemini call for description, hidden ingredients and nutrition
+        sections = analyze_meal_with_gemini(image_data)
+        gemini_description = sections["description"]
         
-        # Step 3: Extract clean ingredients list
-        cleaned_ingredients = extract_ingredients_only(gemini_description)
+        # Fall back to the dedicated description call if the combined response was unusable.
+        # When nothing usable came back at all, stream it and start the follow-up calls from
+        # the dish names while the visible ingredients are still arriving.
+        early_followups = {}
+        
+        def start_followups(dish_names):
+            early_followups["hidden"] = followup_executor.submit(
+                search_hidden_ingredients, dish_names, VISIBLE_NOT_LISTED)
+            early_followups["nutrition"] = followup_executor.submit(
+                estimate_nutrition_from_ingredients, dish_names, VISIBLE_NOT_LISTED)
+        
+        def cancel_followups():
+            # Don't hold followup_executor workers for results that will be thrown away
+            for future in early_followups.values():
+                future.cancel()
+        
+        # Steps 2+3: Extract dish names (could be multiple) and the clean ingredients list
+        dish_names, cleaned_ingredients = parse_description(gemini_description)
+        
+        if not cleaned_ingredients:
+            stream_followups = not sections["hidden"] and not sections["nutrition"]
+            gemini_description = analyze_image_with_gemini(
+                image_data, on_dish_names=start_followups if stream_followups else None)
+            
+            if "Gemini error" in gemini_description:
+                cancel_followups()
+                raise Exception(f"Gemini analysis failed: {gemini_description}")
+            
+            dish_names, cleaned_ingredients = parse_description(gemini_description)
         
         if not cleaned_ingredients:
+            cancel_followups()
             raise Exception("No ingredients could be identified from the image")
         
-        # Step 4: Find hidden ingredients for all dishes
-        hidden_ingredients = search_hidden_ingredients(dish_names, cleaned_ingredients)
+        hidden_ingredients = sections["hidden"]
+        nutrition_info = sections["nutrition"]
+        # Only analyses where every section came from Gemini (no fallback text) get cached
+        hidden_from_gemini = nutrition_from_gemini = True
         
-        # Step 5: Estimate nutrition from ALL ingredients (visible + hidden) for all dishes
-        nutrition_info = estimate_nutrition_from_ingredients(dish_names, cleaned_ingredients, hidden_ingredients)
+        if early_followups:
+            # Steps 4+5: Already started from the streamed dish names
+            hidden_ingredients, hidden_from_gemini = early_followups["hidden"].result()
+            nutrition_info, nutrition_from_gemini = early_followups["nutrition"].result()
+        elif not hidden_ingredients and not nutrition_info:
+            # Steps 4+5: Both missing - run the two follow-up calls concurrently,
+            # nutrition on this thread while hidden ingredients run in the pool
+            hidden_future = followup_executor.submit(search_hidden_ingredients, dish_names, cleaned_ingredients)
+            nutrition_info, nutrition_from_gemini = estimate_nutrition_from_ingredients(dish_names, cleaned_ingredients)
+            hidden_ingredients, hidden_from_gemini = hidden_future.result()
+        elif not hidden_ingredients:
+            # Step 4: Hidden ingredients for all dishes (separate call only if missing)
+            hidden_ingredients, hidden_from_gemini = search_hidden_ingredients(dish_names, cleaned_ingredients)
+        elif not nutrition_info:
+            # Step 5: Nutrition from ALL ingredients (separate call only if missing)
+            nutrition_info, nutrition_from_gemini = estimate_nutrition_from_ingredients(dish_names, cleaned_ingredients, hidden_ingredients)
         
-        # Step 6: Parse data for potential storage
-        visible_dict = parse_to_dict(cleaned_ingredients)
-        hidden_dict = parse_to_dict(hidden_ingredients)
+        # Step 6: Count ingredients - both texts are already one formatted line per ingredient
+        visible_count = cleaned_ingredients.count('\n') + 1
+        hidden_count = hidden_ingredients.count('\n') + 1 if hidden_ingredients else 0
         
         analysis_time = time.time() - start_time
         
-        print(f"✅ Analysis completed in {analysis_time:.2f} seconds")
-        print(f"📍 Dishes/Items: {dish_names}")
-        print(f"📍 Visible ingredients: {len(visible_dict)} items")
-        print(f"📍 Hidden ingredients: {len(hidden_dict)} items")
-        print(f"📍 Hidden ingredients text: {hidden_ingredients[:100]}...")
+        log.info("✅ Analysis completed in %.2f seconds", analysis_time)
+        log.debug("📍 Dishes/Items: %s", dish_names)
+        log.debug("📍 Visible ingredients: %d items", visible_count)
+        log.debug("📍 Hidden ingredients: %d items", hidden_count)
+        log.debug("📍 Hidden ingredients text: %.100s...", hidden_ingredients)
         
         # Return in format expected by Swift frontend
-        return {
+        result = {
             'dish_prediction': dish_names,
             'image_description': cleaned_ingredients,
             'hidden_ingredients': hidden_ingredients,
             'nutrition_info': nutrition_info,
-            'analysis_time': analysis_time,
-            'user_id': user_id,
             'debug_info': {
-                'visible_count': len(visible_dict),
-                'hidden_count': len(hidden_dict),
+                'visible_count': visible_count,
+                'hidden_count': hidden_count,
                 'has_hidden': bool(hidden_ingredients and hidden_ingredients.strip())
             }
         }
+        if early_followups:
+            # Built from the dish names alone - fine for this response, not for later re-uploads
+            log.debug("⚠️ Not caching analysis whose follow-ups started from dish names only")
+        elif hidden_from_gemini and nutrition_from_gemini:
+            store_cached_analysis(cache_key, result, user_id, image_hash)
+            store_similar_analysis(user_id, image_hash, result)
+        else:
+            log.warning("⚠️ Not caching analysis that used fallback sections")
+        
+        result['analysis_time'] = analysis_time
+        result['user_id'] = user_id
+        return result
         
     except Exception as e:
-        print(f"❌ Full analysis error: {str(e)}")
+        log.exception("❌ Full analysis error: %s", e)
         
         # Return error response
         error_msg = str(e)
@@ -330,45 +683,55 @@ def full_image_analysis(image_path, user_id):
 def recalculate_nutrition_enhanced(ingredients_text):
     """Recalculate nutrition based on modified ingredients"""
     try:
-        print(f"🔄 Recalculating nutrition...")
-        
-        prompt = (
-            f"You are a nutritionist.\n"
-            f"Calculate the exact nutritional values for these ingredients:\n\n{ingredients_text}\n\n"
-            "Output each nutrient on a new line in this exact format:\n"
-            "Nutrient | Value | Unit | Reasoning\n"
-            "Value must be a numeric value only.\n"
-            "Include at least: Calories, Protein, Fat, Carbohydrates, Fiber, Sugar, Sodium.\n"
-            "Base calculations on the specific quantities provided.\n"
-            "Be strict with the format."
-        )
-        
-        response = gemini_model.generate_content(prompt)
-        
-        if response and response.text:
-            print("✅ Nutrition recalculated successfully")
-            return response.text
+        log.debug("🔄 Recalculating nutrition...")
+        
+        # Collapse whitespace so re-submits of the same list share one cache entry
+        ingredients_text = "\n".join(" ".join(line.split()) for line in ingredients_text.splitlines() if line.strip())
+        
+        # Stored next to image analyses so repeats survive restarts; case doesn't change the answer
+        cache_key = "recalc:" + hashlib.blake2b(ingredients_text.lower().encode(), digest_size=16).hexdigest()
+        cached_text = get_cached_analysis(cache_key)
+        if cached_text:
+            log.debug("✅ Returning cached nutrition recalculation")
+            return cached_text
+        
+        prompt = RECALCULATE_NUTRITION_PROMPT.format(ingredients_text=ingredients_text)
+        
+        text = generate_content_cached(prompt)
+        
+        if formatted_lines(text):
+            log.debug("✅ Nutrition recalculated successfully")
+            # Shared by every user who submits this list, so only replies with nutrient rows are kept
+            store_cached_analysis(cache_key, text)
+            return text
+        elif text:
+            raise Exception("No nutrient rows in Gemini response")
         else:
             raise Exception("Empty response from Gemini")
             
     except Exception as e:
-        print(f"❌ Nutrition recalculation error: {str(e)}")
+        log.error("❌ Nutrition recalculation error: %s", e)
         error_msg = str(e)
         return f"Calories | 0 | kcal | Recalculation failed: {error_msg}\nProtein | 0 | g | Recalculation failed: {error_msg}\nFat | 0 | g | Recalculation failed: {error_msg}\nCarbohydrates | 0 | g | Recalculation failed: {error_msg}\nFiber | 0 | g | Recalculation failed: {error_msg}\nSugar | 0 | g | Recalculation failed: {error_msg}\nSodium | 0 | mg | Recalculation failed: {error_msg}"
 
-def validate_image_for_analysis(image_path):
-    """Validate image before analysis"""
+def validate_image_for_analysis(image_bytes):
+    """Validate image before analysis
+
+    Returns (image, message) - the opened image to pass on to full_image_analysis,
+    or None with the reason it was rejected.
+    """
     try:
-        with Image.open(image_path) as img:
-            # Check minimum size
-            if img.width < 100 or img.height < 100:
-                return False, "Image too small for analysis"
-            
-            # Check format
-            if img.format not in ['JPEG', 'PNG', 'WEBP']:
-                return False, f"Unsupported format: {img.format}"
-            
-            return True, "Image is valid"
-            
+        img = Image.open(BytesIO(image_bytes))
+        
+        # Check minimum size
+        if img.width < 100 or img.height < 100:
+            return None, "Image too small for analysis"
+        
+        # Check format
+        if img.format not in ['JPEG', 'PNG', 'WEBP']:
+            return None, f"Unsupported format: {img.format}"
+        
+        return img, "Image is valid"
+        
     except Exception as e:
-        return False, f"Invalid image: {str(e)}"
\ No newline at end of file
+        return None, f"Invalid image: {str(e)}"
\ No newline at end of file